@@ -17,7 +17,20 @@
 
 # pytype: skip-file
 
+import concurrent.futures
+import contextlib
+import copy
+import errno
+import inspect
+import io
+import itertools
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
 from collections import defaultdict
 from typing import Any
 from typing import Callable
@@ -26,7 +39,9 @@ from typing import Iterable
 from typing import Optional
 from typing import Sequence
 
+import numpy as np
 import torch
+from apache_beam.io.filesystem import CompressionTypes
 from apache_beam.io.filesystems import FileSystems
 from apache_beam.ml.inference import utils
 from apache_beam.ml.inference.base import ModelHandler
@@ -56,39 +71,331 @@ KeyedTensorInferenceFn = Callable[[
 ],
                                   Iterable[PredictionResult]]
 
+_CPU = torch.device('cpu')
+_CUDA = torch.device('cuda')
+
+# torch.inference_mode() additionally disables view tracking and version
+# counter bumps, but is only available on torch>=1.9.
+_INFERENCE_CTX = getattr(torch, 'inference_mode', torch.no_grad)
+
+# weights_only is available on torch>=1.13 and mmap on torch>=2.1.
+_TORCH_LOAD_PARAMS = inspect.signature(torch.load).parameters
+
+_READ_BUFFER_SIZE = 16 << 20
+_MAX_DOWNLOAD_THREADS = 8
+
+
+def _download_range(path: str, local_path: str, start: int, end: int):
+  with FileSystems.open(path, 'rb') as file:
+    with open(local_path, 'r+b') as local_file:
+      file.seek(start)
+      local_file.seek(start)
+      while start < end:
+        data = file.read(min(_READ_BUFFER_SIZE, end - start))
+        if not data:
+          raise IOError(f'Unexpected end of file while reading {path}.')
+        local_file.write(data)
+        start += len(data)
+
+
+def _download(path: str, local_path: str):
+  """Copies the file at path to local_path.
+
+  Uncompressed files larger than _READ_BUFFER_SIZE are split into contiguous
+  ranges that are read in parallel, which achieves a higher throughput on
+  object stores than a single sequential read.
+  """
+  size = 0
+  if (CompressionTypes.detect_compression_type(path) ==
+      CompressionTypes.UNCOMPRESSED):
+    metadata_list = FileSystems.match([path])[0].metadata_list
+    if len(metadata_list) == 1:
+      size = metadata_list[0].size_in_bytes
+
+  num_threads = min(_MAX_DOWNLOAD_THREADS, -(-size // _READ_BUFFER_SIZE))
+  if num_threads > 1:
+    with open(local_path, 'wb') as local_file:
+      local_file.truncate(size)
+    range_size = -(-size // num_threads)
+    try:
+      with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        futures = [
+            executor.submit(
+                _download_range,
+                path,
+                local_path,
+                start,
+                min(start + range_size, size))
+            for start in range(0, size, range_size)
+        ]
+        for future in futures:
+          future.result()
+      return
+    except (OSError, NotImplementedError) as e:
+      if getattr(e, 'errno', None) == errno.ENOSPC:
+        # Reading sequentially needs just as much local disk.
+        raise
+      # E.g. the file system does not support seeking.
+      logging.warning(
+          "Parallel download of %s failed, reading it sequentially "
+          "instead: %s",
+          path,
+          e)
+
+  with FileSystems.open(path, 'rb') as file:
+    with open(local_path, 'wb') as local_file:
+      shutil.copyfileobj(file, local_file, _READ_BUFFER_SIZE)
+
+
+def _stream_state_dict(
+    state_dict_path: str, device: torch.device, load_kwargs: Dict[str, Any]):
+  file = FileSystems.open(state_dict_path, 'rb')
+  if hasattr(file, 'readinto'):
+    file = io.BufferedReader(file, buffer_size=_READ_BUFFER_SIZE)
+  return torch.load(file, map_location=device, **load_kwargs)
+
+
+def _load_local_state_dict(
+    local_path: str, device: torch.device, load_kwargs: Dict[str, Any]):
+  # Only checkpoints in the zip format written by torch.save() since torch 1.6
+  # can be memory-mapped, not those saved with
+  # _use_new_zipfile_serialization=False.
+  if zipfile.is_zipfile(local_path):
+    load_kwargs = dict(load_kwargs, mmap=True)
+  return torch.load(local_path, map_location=device, **load_kwargs)
+
+
+def _load_state_dict(state_dict_path: str, device: torch.device):
+  """Loads the state_dict stored at state_dict_path onto device.
+
+  Where torch supports it, only tensors and primitive containers are
+  unpickled and zip format checkpoints are memory-mapped, so tensor storages
+  are paged in on demand rather than read into memory up front. Checkpoints
+  that are remote or compressed are first downloaded to a local temporary
+  file, which needs as much free disk in the default temporary directory as
+  the (uncompressed) checkpoint takes. The file is unlinked once loaded, but
+  its disk space is only freed once the tensors mapped from it, e.g. the
+  parameters of a model on the CPU, are released. If the disk runs out of
+  space, the checkpoint is read into memory instead.
+  """
+  load_kwargs = {}
+  if 'weights_only' in _TORCH_LOAD_PARAMS:
+    load_kwargs['weights_only'] = True
+  if 'mmap' not in _TORCH_LOAD_PARAMS:
+    return _stream_state_dict(state_dict_path, device, load_kwargs)
+
+  if (FileSystems.get_scheme(state_dict_path) is None and
+      CompressionTypes.detect_compression_type(
+          state_dict_path) == CompressionTypes.UNCOMPRESSED):
+    return _load_local_state_dict(state_dict_path, device, load_kwargs)
+
+  fd, local_path = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    try:
+      _download(state_dict_path, local_path)
+    except OSError as e:
+      if e.errno != errno.ENOSPC:
+        raise
+      logging.warning(
+          "Not enough local disk space to download %s, reading it into "
+          "memory instead: %s",
+          state_dict_path,
+          e)
+    else:
+      return _load_local_state_dict(local_path, device, load_kwargs)
+  finally:
+    try:
+      # Existing mappings of the file stay valid once it is unlinked.
+      os.remove(local_path)
+    except OSError:
+      logging.warning("Failed to remove temporary file %s", local_path)
+  return _stream_state_dict(state_dict_path, device, load_kwargs)
+
+
+# assign is available on torch>=2.1.
+_LOAD_STATE_DICT_ASSIGN = 'assign' in inspect.signature(
+    torch.nn.Module.load_state_dict).parameters
+
+
+def _assign_state_dict(
+    model_class: torch.nn.Module, state_dict,
+    **model_params) -> Optional[torch.nn.Module]:
+  """Builds the model on the meta device and assigns the (already on device)
+  tensors of state_dict to it as its parameters and buffers.
+
+  This avoids initializing parameters only to overwrite them, and skips the
+  copies made by load_state_dict() and module.to(). Returns None if the model
+  cannot be built this way, e.g. because state_dict differs in dtype from the
+  model or does not cover all of its tensors.
+  """
+  try:
+    with torch.device('meta'):
+      model = model_class(**model_params)
+  except Exception:  # pylint: disable=broad-except
+    logging.debug(
+        "Failed to build the model on the meta device.", exc_info=True)
+    return None
+  for name, tensor in model.state_dict().items():
+    if name not in state_dict or state_dict[name].dtype != tensor.dtype:
+      return None
+  model.load_state_dict(state_dict, assign=True)
+  # Non-persistent buffers are not part of state_dict, and neither are Tensors
+  # that are plain attributes of a module, so both stay on meta.
+  for module in model.modules():
+    for value in itertools.chain(module.buffers(recurse=False),
+                                 vars(module).values()):
+      if isinstance(value, torch.Tensor) and value.is_meta:
+        return None
+  return model
+
 
 def _load_model(
     model_class: torch.nn.Module, state_dict_path, device, **model_params):
-  model = model_class(**model_params)
-
-  if device == torch.device('cuda') and not torch.cuda.is_available():
+  if device.type == 'cuda' and not torch.cuda.is_available():
     logging.warning(
         "Model handler specified a 'GPU' device, but GPUs are not available. " \
         "Switching to CPU.")
-    device = torch.device('cpu')
+    device = _CPU
 
-  file = FileSystems.open(state_dict_path, 'rb')
   try:
     logging.info(
         "Loading state_dict_path %s onto a %s device", state_dict_path, device)
-    state_dict = torch.load(file, map_location=device)
+    state_dict = _load_state_dict(state_dict_path, device)
   except RuntimeError as e:
-    if device == torch.device('cuda'):
+    if device.type == 'cuda':
       message = "Loading the model onto a GPU device failed due to an " \
         f"exception:\n{e}\nAttempting to load onto a CPU device instead."
       logging.warning(message)
-      return _load_model(
-          model_class, state_dict_path, torch.device('cpu'), **model_params)
+      return _load_model(model_class, state_dict_path, _CPU, **model_params)
     else:
       raise e
 
-  model.load_state_dict(state_dict)
-  model.to(device)
+  model = None
+  if _LOAD_STATE_DICT_ASSIGN:
+    model = _assign_state_dict(model_class, state_dict, **model_params)
+  if model is None:
+    model = model_class(**model_params)
+    model.load_state_dict(state_dict)
+    model.to(device)
   model.eval()
   logging.info("Finished loading PyTorch model.")
   return model, device
 
 
+_INFERENCE_DTYPES = (None, torch.float16, torch.bfloat16, torch.qint8)
+
+
+def _quantize_model(
+    model: torch.nn.Module, device: torch.device) -> torch.nn.Module:
+  if device.type != 'cpu':
+    logging.warning(
+        "Dynamic int8 quantization is only supported on CPU devices. " \
+        "Running the model without quantizing it.")
+    return model
+  try:
+    from torch.ao.quantization import quantize_dynamic
+  except ImportError:
+    # torch.ao was introduced in torch 1.10.
+    from torch.quantization import quantize_dynamic
+  logging.info("Quantizing the Linear layers of the PyTorch model to int8.")
+  return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _autocast(device: torch.device, inference_dtype: Optional[torch.dtype]):
+  if (inference_dtype not in (torch.float16, torch.bfloat16) or
+      not hasattr(torch, 'autocast')):
+    return contextlib.nullcontext()
+  return torch.autocast(device.type, dtype=inference_dtype)
+
+
+def _get_positive_int_env(name: str) -> Optional[int]:
+  value = os.environ.get(name)
+  if value is None:
+    return None
+  try:
+    number = int(value)
+  except ValueError:
+    number = 0
+  if number < 1:
+    logging.warning(
+        "Ignoring the %s environment variable, which must be a positive "
+        "integer, got %r.",
+        name,
+        value)
+    return None
+  return number
+
+
+def _set_num_threads(num_threads: Optional[int]):
+  if num_threads is None:
+    num_threads = _get_positive_int_env('BEAM_CPU_THREADS_PER_WORKER')
+  if num_threads is None:
+    workers_per_vm = _get_positive_int_env('BEAM_WORKERS_PER_VM')
+    if workers_per_vm is None:
+      return
+    num_threads = max(1, (os.cpu_count() or 1) // workers_per_vm)
+  logging.info("Setting the number of PyTorch threads to %d", num_threads)
+  torch.set_num_threads(num_threads)
+  try:
+    torch.set_num_interop_threads(1)
+  except RuntimeError:
+    # This can only be set once per process, before any inter-op work ran.
+    logging.debug("The number of PyTorch inter-op threads was already set.")
+
+
+def _inference_args_to_device(
+    inference_args: Dict[str, Any], device: torch.device) -> Dict[str, Any]:
+  # As for batches, only copies to a GPU may be issued asynchronously.
+  non_blocking = device.type == 'cuda'
+  moved = {}
+  for name, value in inference_args.items():
+    if isinstance(value, torch.Tensor):
+      value = value.to(device, non_blocking=non_blocking)
+    moved[name] = value
+  return moved
+
+
+# torch.compile() modes that capture CUDA graphs of the model.
+_CUDA_GRAPH_COMPILE_MODES = ('reduce-overhead', 'max-autotune')
+
+
+def _validate_torch_compile_kwargs(
+    torch_compile_kwargs: Optional[Dict[str, Any]]):
+  if torch_compile_kwargs is None:
+    return
+  options = torch_compile_kwargs.get('options') or {}
+  if (torch_compile_kwargs.get('mode') in _CUDA_GRAPH_COMPILE_MODES or
+      options.get('triton.cudagraphs')):
+    # The outputs of a replayed graph are overwritten by the next replay,
+    # while predictions of earlier batches may still be held downstream.
+    raise ValueError(
+        'torch_compile_kwargs must not enable CUDA graphs, got '
+        f'{torch_compile_kwargs}. Use a mode such as '
+        '"max-autotune-no-cudagraphs", or use_cuda_graphs=True of '
+        'PytorchModelHandlerTensor, which copies the outputs of each replay.')
+
+
+def _compile_model(
+    model: torch.nn.Module,
+    torch_compile_kwargs: Dict[str, Any],
+    batching_kwargs: Dict[str, int]) -> torch.nn.Module:
+  if not hasattr(torch, 'compile'):
+    logging.warning(
+        "torch_compile_kwargs were provided, but torch.compile() requires " \
+        "torch>=2.0. Running the model without compiling it.")
+    return model
+  torch_compile_kwargs = dict(torch_compile_kwargs)
+  # All but the final batch of a bundle share a single size when the min and
+  # max batch sizes are the same, so specialize on static shapes.
+  min_batch_size = batching_kwargs.get('min_batch_size')
+  if (min_batch_size is not None and
+      min_batch_size == batching_kwargs.get('max_batch_size')):
+    torch_compile_kwargs.setdefault('dynamic', False)
+  logging.info("Compiling PyTorch model with %s", torch_compile_kwargs)
+  return torch.compile(model, **torch_compile_kwargs)
+
+
 def _convert_to_device(examples: torch.Tensor, device) -> torch.Tensor:
   """
   Converts samples to a style matching given device.
@@ -96,9 +403,176 @@ def _convert_to_device(examples: torch.Tensor, device) -> torch.Tensor:
   **NOTE:** A user may pass in device='GPU' but if GPU is not detected in the
   environment it must be converted back to CPU.
   """
-  if examples.device != device:
-    examples = examples.to(device)
-  return examples
+  # Tensor.to() already returns examples itself if it resides on device, and
+  # copies from host memory need not block as the model runs on the same
+  # stream. Copies to the CPU must block before results are read.
+  return examples.to(device, non_blocking=device.type == 'cuda')
+
+
+def _iter_data_ptrs(outputs):
+  """Yields the device and data address of every Tensor and numpy array nested
+  in a (possibly) structured model output."""
+  if isinstance(outputs, torch.Tensor):
+    # Sparse and nested Tensors have no single storage to view the buffers by.
+    # is_nested is available on torch>=1.13.
+    if (outputs.layout == torch.strided and
+        not getattr(outputs, 'is_nested', False)):
+      yield outputs.device, outputs.data_ptr()
+  elif isinstance(outputs, np.ndarray):
+    # E.g. the result of Tensor.numpy(), which shares the Tensor's memory.
+    yield _CPU, outputs.__array_interface__['data'][0]
+  elif isinstance(outputs, dict):
+    for value in outputs.values():
+      yield from _iter_data_ptrs(value)
+  elif isinstance(outputs, (list, tuple)):
+    for value in outputs:
+      yield from _iter_data_ptrs(value)
+
+
+class _BatchBuffers(object):
+  """Reusable buffers that batches of identically shaped CPU Tensors are
+  stacked into before they are handed to a model.
+
+  For a CPU device each batch is stacked directly into the reused buffer.
+  For a GPU device it is stacked into a pinned host buffer and copied
+  asynchronously into the reused device buffer. Either way no memory is
+  allocated for model inputs in steady state. Buffers grow to the largest
+  batch seen so far and every batch uses a leading slice of them.
+  """
+  def __init__(self):
+    self._target = None
+    self._buffer = None
+    self._host = None
+    self._copied = None
+
+  def stack_to_device(
+      self, batch: Sequence[torch.Tensor],
+      device: torch.device) -> Optional[torch.Tensor]:
+    """Returns the stacked batch on device, or None if batch holds anything
+    but CPU Tensors of a single shape and dtype."""
+    if not isinstance(batch[0], torch.Tensor):
+      return None
+    shape = batch[0].shape
+    dtype = batch[0].dtype
+    for tensor in batch:
+      if (not isinstance(tensor, torch.Tensor) or tensor.shape != shape or
+          tensor.dtype != dtype or tensor.device.type != 'cpu'):
+        return None
+
+    n = len(batch)
+    buffer = self._buffer
+    if (buffer is None or buffer.shape[0] < n or buffer.shape[1:] != shape or
+        buffer.dtype != dtype or self._target != device):
+      buffer_shape = (n, ) + tuple(shape)
+      buffer = torch.empty(buffer_shape, dtype=dtype, device=device)
+      self._target = device
+      self._buffer = buffer
+      if device.type == 'cuda':
+        self._host = torch.empty(buffer_shape, dtype=dtype, pin_memory=True)
+        self._copied = torch.cuda.Event()
+      else:
+        self._host = self._copied = None
+    elif self._copied is not None:
+      # The previous batch may still be in flight from the host buffer.
+      self._copied.synchronize()
+
+    batched_tensors = buffer[:n]
+    if self._host is None:
+      return torch.stack(batch, out=batched_tensors)
+    host = self._host[:n]
+    torch.stack(batch, out=host)
+    batched_tensors.copy_(host, non_blocking=True)
+    self._copied.record()
+    return batched_tensors
+
+  def release_if_aliased(self, outputs):
+    """Drops the buffers if any Tensor or numpy array in outputs views their
+    memory, as the next batch would otherwise overwrite the returned
+    predictions."""
+    if self._buffer is None:
+      return
+    start = self._buffer.data_ptr()
+    end = start + self._buffer.numel() * self._buffer.element_size()
+    for device, data_ptr in _iter_data_ptrs(outputs):
+      if device == self._buffer.device and start <= data_ptr < end:
+        self._target = self._buffer = self._host = self._copied = None
+        return
+
+
+# Models are shared between the threads of a worker, so buffers are kept per
+# thread and released together with the model they were created for.
+_batch_buffers_local = threading.local()
+
+
+def _get_batch_buffers(model: torch.nn.Module) -> Dict[Any, _BatchBuffers]:
+  """Returns this thread's buffers for model, keyed by input key."""
+  buffers_by_model = getattr(_batch_buffers_local, 'buffers_by_model', None)
+  if buffers_by_model is None:
+    buffers_by_model = weakref.WeakKeyDictionary()
+    _batch_buffers_local.buffers_by_model = buffers_by_model
+  buffers = buffers_by_model.get(model)
+  if buffers is None:
+    buffers = {}
+    buffers_by_model[model] = buffers
+  return buffers
+
+
+def _stack_to_device(
+    batch: Sequence[torch.Tensor],
+    model: torch.nn.Module,
+    device: torch.device,
+    key: Optional[str] = None) -> torch.Tensor:
+  """Stacks batch into a single Tensor on device.
+
+  CPU Tensors are stacked into the reusable buffers kept for the given model
+  and input key; on a GPU device the batch then lands on the device with a
+  single asynchronous copy. Tensors that already reside on another device
+  are stacked there.
+  """
+  buffers = _get_batch_buffers(model)
+  key_buffers = buffers.get(key)
+  if key_buffers is None:
+    key_buffers = buffers[key] = _BatchBuffers()
+  batched_tensors = key_buffers.stack_to_device(batch, device)
+  if batched_tensors is not None:
+    return batched_tensors
+  batched_tensors = torch.stack(batch)
+  return _convert_to_device(batched_tensors, device)
+
+
+def _release_aliased_buffers(model: torch.nn.Module, outputs):
+  for buffers in _get_batch_buffers(model).values():
+    buffers.release_if_aliased(outputs)
+
+
+def _stack_keyed_to_device(
+    batch: Sequence[Dict[str, torch.Tensor]],
+    model: torch.nn.Module,
+    device: torch.device) -> Dict[str, torch.Tensor]:
+  """Groups the Tensors in batch by key and stacks each group on device.
+
+  Host to device copies are issued asynchronously on the current stream, so
+  copies for different keys overlap and the model launched afterwards on the
+  same stream observes all of them without an explicit synchronization.
+  """
+  # If elements in `batch` are provided as a dictionaries from key to Tensors,
+  # then iterate through the batch list, and group Tensors to the same key
+  keys = batch[0].keys()
+  if all(example.keys() == keys for example in batch):
+    key_to_tensor_list = {
+        key: [example[key] for example in batch]
+        for key in keys
+    }
+  else:
+    key_to_tensor_list = defaultdict(list)
+    for example in batch:
+      for key, tensor in example.items():
+        key_to_tensor_list[key].append(tensor)
+  key_to_batched_tensors = {}
+  for key, tensor_list in key_to_tensor_list.items():
+    key_to_batched_tensors[key] = _stack_to_device(
+        tensor_list, model, device, key)
+  return key_to_batched_tensors
 
 
 def default_tensor_inference_fn(
@@ -108,15 +582,142 @@ def default_tensor_inference_fn(
     inference_args: Optional[Dict[str, Any]] = None,
     model_id: Optional[str] = None,
 ) -> Iterable[PredictionResult]:
-  # torch.no_grad() mitigates GPU memory issues
+  # Disabling autograd mitigates GPU memory issues
   # https://github.com/apache/beam/issues/22811
-  with torch.no_grad():
-    batched_tensors = torch.stack(batch)
-    batched_tensors = _convert_to_device(batched_tensors, device)
+  with _INFERENCE_CTX():
+    batched_tensors = _stack_to_device(batch, model, device)
     predictions = model(batched_tensors, **inference_args)
+    _release_aliased_buffers(model, predictions)
+    del batched_tensors
+  return utils._convert_to_result(batch, predictions, model_id)
+
+
+def _clone_tensors(outputs):
+  """Clones every Tensor nested in a (possibly) structured model output,
+  keeping the types of its containers."""
+  if isinstance(outputs, torch.Tensor):
+    return outputs.clone()
+  if isinstance(outputs, dict):
+    # A shallow copy keeps the type of dict subclasses, e.g. ModelOutput.
+    cloned = copy.copy(outputs)
+    for key, value in outputs.items():
+      cloned[key] = _clone_tensors(value)
+    return cloned
+  if isinstance(outputs, tuple) and hasattr(outputs, '_fields'):
+    # namedtuples take their fields as positional arguments.
+    return type(outputs)(*(_clone_tensors(value) for value in outputs))
+  if isinstance(outputs, (list, tuple)):
+    return type(outputs)(_clone_tensors(value) for value in outputs)
+  return outputs
+
+
+class _CUDAGraphRunner(object):
+  """Runs default_tensor_inference_fn by replaying CUDA graphs of the model's
+  forward() call, which removes the CPU overhead of launching its kernels.
+
+  A graph is captured the first time a batch of a given shape and dtype is
+  seen, for up to _MAX_GRAPHS distinct shapes. Other batches, and batches for
+  which capture fails, run eagerly.
+
+  A single runner is shared by all threads running a model, see
+  _get_cuda_graph_runner. Capturing a graph and replaying it, up to cloning
+  its outputs, hold a lock, as the graphs' static inputs and outputs are
+  shared. Other threads keep running eager batches meanwhile, so graphs are
+  captured in thread local error mode where torch supports it, which lets
+  those threads allocate memory and synchronize during a capture.
+  """
+  _MAX_GRAPHS = 4
+  _NUM_WARMUP_ITERS = 3
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (shape, dtype, inference args) -> (graph, input, output, inference_args)
+    self._graphs = {}
+
+  def _capture(self, model, batched_tensors, inference_args):
+    static_input = batched_tensors.clone()
+    try:
+      # Warm up on a side stream, as required before capturing a graph.
+      stream = torch.cuda.Stream()
+      stream.wait_stream(torch.cuda.current_stream())
+      with torch.cuda.stream(stream):
+        for _ in range(self._NUM_WARMUP_ITERS):
+          model(static_input, **inference_args)
+      torch.cuda.current_stream().wait_stream(stream)
+      graph = torch.cuda.CUDAGraph()
+      graph_kwargs = {}
+      # capture_error_mode is available on torch>=2.0.
+      if 'capture_error_mode' in inspect.signature(torch.cuda.graph).parameters:
+        graph_kwargs['capture_error_mode'] = 'thread_local'
+      with torch.cuda.graph(graph, **graph_kwargs):
+        static_output = model(static_input, **inference_args)
+    except RuntimeError as e:
+      logging.warning(
+          "Failed to capture a CUDA graph for a batch of shape %s, running "
+          "the model eagerly for this shape instead: %s",
+          tuple(batched_tensors.shape),
+          e)
+      return None
+    # inference_args are kept alive so that the ids in the key stay unique.
+    return graph, static_input, static_output, inference_args
+
+  def run_inference(
+      self,
+      batch: Sequence[torch.Tensor],
+      model: torch.nn.Module,
+      device: torch.device,
+      inference_args: Dict[str, Any],
+      model_id: Optional[str] = None) -> Iterable[PredictionResult]:
+    with _INFERENCE_CTX():
+      batched_tensors = _stack_to_device(batch, model, device)
+      key = (
+          batched_tensors.shape,
+          batched_tensors.dtype,
+          tuple((name, id(value)) for name, value in inference_args.items()))
+      with self._lock:
+        if key not in self._graphs and len(self._graphs) < self._MAX_GRAPHS:
+          self._graphs[key] = self._capture(
+              model, batched_tensors, inference_args)
+        entry = self._graphs.get(key)
+        if entry is not None:
+          graph, static_input, static_output, _ = entry
+          static_input.copy_(batched_tensors)
+          graph.replay()
+          # The next replay overwrites static_output. Predictions are passed
+          # downstream as views that can outlive this batch, so they need
+          # memory of their own rather than a slot in a reused output buffer.
+          predictions = _clone_tensors(static_output)
+      if entry is None:
+        predictions = model(batched_tensors, **inference_args)
+        _release_aliased_buffers(model, predictions)
+      del batched_tensors
     return utils._convert_to_result(batch, predictions, model_id)
 
 
+def _is_on_cuda(model: torch.nn.Module) -> bool:
+  parameter = next(model.parameters(), None)
+  return parameter is not None and parameter.device.type == 'cuda'
+
+
+# The model is loaded by one handler and shared with the handlers of the other
+# threads, so runners are kept per model rather than per handler.
+_cuda_graph_runners = weakref.WeakKeyDictionary()
+_cuda_graph_runners_lock = threading.Lock()
+
+
+def _get_cuda_graph_runner(model: torch.nn.Module) -> _CUDAGraphRunner:
+  """Returns the runner shared by all threads running model.
+
+  Graphs captured by a runner per thread would multiply their memory pools
+  by the number of threads.
+  """
+  with _cuda_graph_runners_lock:
+    runner = _cuda_graph_runners.get(model)
+    if runner is None:
+      runner = _cuda_graph_runners[model] = _CUDAGraphRunner()
+    return runner
+
+
 def make_tensor_model_fn(model_fn: str) -> TensorInferenceFn:
   """
   Produces a TensorInferenceFn that uses a method of the model other that
@@ -126,6 +727,9 @@ def make_tensor_model_fn(model_fn: str) -> TensorInferenceFn:
     model_fn: A string name of the method to be used. This is accessed through
       getattr(model, model_fn)
   """
+  # (model, bound method) of the most recently seen model.
+  cache = [(None, None)]
+
   def attr_fn(
       batch: Sequence[torch.Tensor],
       model: torch.nn.Module,
@@ -133,12 +737,16 @@ def make_tensor_model_fn(model_fn: str) -> TensorInferenceFn:
       inference_args: Optional[Dict[str, Any]] = None,
       model_id: Optional[str] = None,
   ) -> Iterable[PredictionResult]:
-    with torch.no_grad():
-      batched_tensors = torch.stack(batch)
-      batched_tensors = _convert_to_device(batched_tensors, device)
-      pred_fn = getattr(model, model_fn)
+    with _INFERENCE_CTX():
+      batched_tensors = _stack_to_device(batch, model, device)
+      cached_model, pred_fn = cache[0]
+      if cached_model is not model:
+        pred_fn = getattr(model, model_fn)
+        cache[0] = (model, pred_fn)
       predictions = pred_fn(batched_tensors, **inference_args)
-      return utils._convert_to_result(batch, predictions, model_id)
+      _release_aliased_buffers(model, predictions)
+      del batched_tensors
+    return utils._convert_to_result(batch, predictions, model_id)
 
   return attr_fn
 
@@ -155,7 +763,11 @@ class PytorchModelHandlerTensor(ModelHandler[torch.Tensor,
       *,
       inference_fn: TensorInferenceFn = default_tensor_inference_fn,
       min_batch_size: Optional[int] = None,
-      max_batch_size: Optional[int] = None):
+      max_batch_size: Optional[int] = None,
+      torch_compile_kwargs: Optional[Dict[str, Any]] = None,
+      inference_dtype: Optional[torch.dtype] = None,
+      use_cuda_graphs: bool = False,
+      num_threads: Optional[int] = None):
     """Implementation of the ModelHandler interface for PyTorch.
 
     Example Usage::
@@ -176,17 +788,46 @@ class PytorchModelHandlerTensor(ModelHandler[torch.Tensor,
         Otherwise, it will be CPU.
       inference_fn: the inference function to use during RunInference.
         default=_default_tensor_inference_fn
+      torch_compile_kwargs: keyword arguments to pass to torch.compile() to
+        compile the loaded model, e.g.
+        ``{'mode': 'max-autotune-no-cudagraphs'}``. The model is not compiled
+        if None. Requires torch>=2.0. Modes and options that capture CUDA
+        graphs, such as ``'reduce-overhead'`` and ``'max-autotune'``, are
+        rejected, as each replay overwrites the predictions returned for the
+        previous batch.
+      inference_dtype: the dtype to run inference in. ``torch.float16`` and
+        ``torch.bfloat16`` run the model under torch.autocast(), and
+        predictions are returned in that dtype where autocast applies.
+        ``torch.qint8`` dynamically quantizes the Linear layers of the model
+        when running on CPU. If None, the model runs in the dtype it was
+        loaded in.
+      use_cuda_graphs: when running on a GPU, capture the model's forward()
+        call as a CUDA graph for each batch shape and replay it on subsequent
+        batches of that shape. Pinning min_batch_size and max_batch_size to
+        the same value keeps the number of shapes small. The model must be
+        capturable, i.e. free of CPU synchronization and data dependent
+        control flow. Only supported with the default inference_fn and
+        without a float16 or bfloat16 inference_dtype.
+      num_threads: the number of threads PyTorch uses for intra-op
+        parallelism on CPU. Defaults to the BEAM_CPU_THREADS_PER_WORKER
+        environment variable if set, or else to the number of CPUs divided by
+        the BEAM_WORKERS_PER_VM environment variable if set, so that several
+        SDK worker processes on one machine do not oversubscribe its cores.
+        Otherwise the PyTorch default is kept.
 
     **Supported Versions:** RunInference APIs in Apache Beam have been tested
     with PyTorch 1.9 and 1.10.
     """
     self._state_dict_path = state_dict_path
     if device == 'GPU':
+      # Handlers are usually constructed where the pipeline is launched rather
+      # than on the workers, so GPU availability is only checked once the
+      # model is loaded.
       logging.info("Device is set to CUDA")
-      self._device = torch.device('cuda')
+      self._device = _CUDA
     else:
       logging.info("Device is set to CPU")
-      self._device = torch.device('cpu')
+      self._device = _CPU
     self._model_class = model_class
     self._model_params = model_params
     self._inference_fn = inference_fn
@@ -195,15 +836,42 @@ class PytorchModelHandlerTensor(ModelHandler[torch.Tensor,
       self._batching_kwargs['min_batch_size'] = min_batch_size
     if max_batch_size is not None:
       self._batching_kwargs['max_batch_size'] = max_batch_size
+    _validate_torch_compile_kwargs(torch_compile_kwargs)
+    self._torch_compile_kwargs = torch_compile_kwargs
+    if num_threads is not None and num_threads < 1:
+      raise ValueError(f'num_threads must be positive, got {num_threads}.')
+    self._num_threads = num_threads
+    # (inference_args, device, inference_args with Tensors moved to device)
+    self._device_inference_args = (None, None, None)
+    if inference_dtype not in _INFERENCE_DTYPES:
+      raise ValueError(
+          f'inference_dtype must be one of {_INFERENCE_DTYPES}, got '
+          f'{inference_dtype}.')
+    self._inference_dtype = inference_dtype
+    if use_cuda_graphs:
+      if inference_fn is not default_tensor_inference_fn:
+        raise ValueError(
+            'use_cuda_graphs is only supported with the default inference_fn.')
+      if inference_dtype in (torch.float16, torch.bfloat16):
+        raise ValueError(
+            'use_cuda_graphs is not supported with a float16 or bfloat16 '
+            'inference_dtype.')
+    self._use_cuda_graphs = use_cuda_graphs
 
   def load_model(self) -> torch.nn.Module:
     """Loads and initializes a Pytorch model for processing."""
+    _set_num_threads(self._num_threads)
     model, device = _load_model(
         self._model_class,
         self._state_dict_path,
         self._device,
         **self._model_params)
     self._device = device
+    if self._inference_dtype == torch.qint8:
+      model = _quantize_model(model, device)
+    if self._torch_compile_kwargs is not None:
+      model = _compile_model(
+          model, self._torch_compile_kwargs, self._batching_kwargs)
     return model
 
   def update_model_path(self, model_path: Optional[str] = None):
@@ -230,22 +898,45 @@ class PytorchModelHandlerTensor(ModelHandler[torch.Tensor,
       model: A PyTorch model.
       inference_args: Non-batchable arguments required as inputs to the model's
         forward() function. Unlike Tensors in `batch`, these parameters will
-        not be dynamically batched
+        not be dynamically batched. Tensors among them are moved to the
+        model's device. Arguments that must stay on the host, e.g. the
+        lengths passed to pack_padded_sequence(), can be passed as lists.
 
     Returns:
       An Iterable of type PredictionResult.
     """
-    inference_args = {} if not inference_args else inference_args
+    inference_args = self._get_device_inference_args(inference_args)
 
-    return self._inference_fn(
-        batch, model, self._device, inference_args, self._state_dict_path)
+    if self._use_cuda_graphs and _is_on_cuda(model):
+      return _get_cuda_graph_runner(model).run_inference(
+          batch, model, self._device, inference_args, self._state_dict_path)
+    with _autocast(self._device, self._inference_dtype):
+      return self._inference_fn(
+          batch, model, self._device, inference_args, self._state_dict_path)
+
+  def _get_device_inference_args(
+      self, inference_args: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Returns inference_args with their Tensors moved to the model's device.
+
+    RunInference passes the same inference_args to every batch, so the moved
+    Tensors are cached rather than transferred again for each batch.
+    """
+    if not inference_args:
+      return {}
+    source, device, device_inference_args = self._device_inference_args
+    if source is not inference_args or device != self._device:
+      device_inference_args = _inference_args_to_device(
+          inference_args, self._device)
+      self._device_inference_args = (
+          inference_args, self._device, device_inference_args)
+    return device_inference_args
 
   def get_num_bytes(self, batch: Sequence[torch.Tensor]) -> int:
     """
     Returns:
       The number of bytes of data for a batch of Tensors.
     """
-    return sum((el.element_size() for tensor in batch for el in tensor))
+    return sum((tensor.numel() * tensor.element_size() for tensor in batch))
 
   def get_metrics_namespace(self) -> str:
     """
@@ -268,24 +959,15 @@ def default_keyed_tensor_inference_fn(
     inference_args: Optional[Dict[str, Any]] = None,
     model_id: Optional[str] = None,
 ) -> Iterable[PredictionResult]:
-  # If elements in `batch` are provided as a dictionaries from key to Tensors,
-  # then iterate through the batch list, and group Tensors to the same key
-  key_to_tensor_list = defaultdict(list)
-
-  # torch.no_grad() mitigates GPU memory issues
+  # Disabling autograd mitigates GPU memory issues
   # https://github.com/apache/beam/issues/22811
-  with torch.no_grad():
-    for example in batch:
-      for key, tensor in example.items():
-        key_to_tensor_list[key].append(tensor)
-    key_to_batched_tensors = {}
-    for key in key_to_tensor_list:
-      batched_tensors = torch.stack(key_to_tensor_list[key])
-      batched_tensors = _convert_to_device(batched_tensors, device)
-      key_to_batched_tensors[key] = batched_tensors
+  with _INFERENCE_CTX():
+    key_to_batched_tensors = _stack_keyed_to_device(batch, model, device)
     predictions = model(**key_to_batched_tensors, **inference_args)
+    _release_aliased_buffers(model, predictions)
+    del key_to_batched_tensors
 
-    return utils._convert_to_result(batch, predictions, model_id)
+  return utils._convert_to_result(batch, predictions, model_id)
 
 
 def make_keyed_tensor_model_fn(model_fn: str) -> KeyedTensorInferenceFn:
@@ -297,6 +979,9 @@ def make_keyed_tensor_model_fn(model_fn: str) -> KeyedTensorInferenceFn:
     model_fn: A string name of the method to be used. This is accessed through
       getattr(model, model_fn)
   """
+  # (model, bound method) of the most recently seen model.
+  cache = [(None, None)]
+
   def attr_fn(
       batch: Sequence[Dict[str, torch.Tensor]],
       model: torch.nn.Module,
@@ -304,23 +989,17 @@ def make_keyed_tensor_model_fn(model_fn: str) -> KeyedTensorInferenceFn:
       inference_args: Optional[Dict[str, Any]] = None,
       model_id: Optional[str] = None,
   ) -> Iterable[PredictionResult]:
-    # If elements in `batch` are provided as a dictionaries from key to Tensors,
-    # then iterate through the batch list, and group Tensors to the same key
-    key_to_tensor_list = defaultdict(list)
-
-    # torch.no_grad() mitigates GPU memory issues
+    # Disabling autograd mitigates GPU memory issues
     # https://github.com/apache/beam/issues/22811
-    with torch.no_grad():
-      for example in batch:
-        for key, tensor in example.items():
-          key_to_tensor_list[key].append(tensor)
-      key_to_batched_tensors = {}
-      for key in key_to_tensor_list:
-        batched_tensors = torch.stack(key_to_tensor_list[key])
-        batched_tensors = _convert_to_device(batched_tensors, device)
-        key_to_batched_tensors[key] = batched_tensors
+    with _INFERENCE_CTX():
+      key_to_batched_tensors = _stack_keyed_to_device(batch, model, device)
+      cached_model, pred_fn = cache[0]
+      if cached_model is not model:
         pred_fn = getattr(model, model_fn)
+        cache[0] = (model, pred_fn)
       predictions = pred_fn(**key_to_batched_tensors, **inference_args)
+      _release_aliased_buffers(model, predictions)
+      del key_to_batched_tensors
     return utils._convert_to_result(batch, predictions, model_id)
 
   return attr_fn
@@ -339,7 +1018,11 @@ class PytorchModelHandlerKeyedTensor(ModelHandler[Dict[str, torch.Tensor],
       *,
       inference_fn: KeyedTensorInferenceFn = default_keyed_tensor_inference_fn,
       min_batch_size: Optional[int] = None,
-      max_batch_size: Optional[int] = None):
+      max_batch_size: Optional[int] = None,
+      torch_compile_kwargs: Optional[Dict[str, Any]] = None,
+      inference_dtype: Optional[torch.dtype] = None,
+      length_fn: Optional[Callable[[Dict[str, torch.Tensor]], int]] = None,
+      num_threads: Optional[int] = None):
     """Implementation of the ModelHandler interface for PyTorch.
 
     Example Usage::
@@ -364,17 +1047,44 @@ class PytorchModelHandlerKeyedTensor(ModelHandler[Dict[str, torch.Tensor],
         Otherwise, it will be CPU.
       inference_fn: the function to invoke on run_inference.
         default = default_keyed_tensor_inference_fn
+      torch_compile_kwargs: keyword arguments to pass to torch.compile() to
+        compile the loaded model, e.g.
+        ``{'mode': 'max-autotune-no-cudagraphs'}``. The model is not compiled
+        if None. Requires torch>=2.0. Modes and options that capture CUDA
+        graphs, such as ``'reduce-overhead'`` and ``'max-autotune'``, are
+        rejected, as each replay overwrites the predictions returned for the
+        previous batch.
+      inference_dtype: the dtype to run inference in. ``torch.float16`` and
+        ``torch.bfloat16`` run the model under torch.autocast(), and
+        predictions are returned in that dtype where autocast applies.
+        ``torch.qint8`` dynamically quantizes the Linear layers of the model
+        when running on CPU. If None, the model runs in the dtype it was
+        loaded in.
+      length_fn: a function returning the length (e.g. number of tokens) of
+        an example. If set, each batch is split into groups of examples of
+        equal length, and inference_fn is invoked once per group, so examples
+        of varying length can be batched together without padding them to a
+        common length. Tensors within a group must still be stackable.
+      num_threads: the number of threads PyTorch uses for intra-op
+        parallelism on CPU. Defaults to the BEAM_CPU_THREADS_PER_WORKER
+        environment variable if set, or else to the number of CPUs divided by
+        the BEAM_WORKERS_PER_VM environment variable if set, so that several
+        SDK worker processes on one machine do not oversubscribe its cores.
+        Otherwise the PyTorch default is kept.
 
     **Supported Versions:** RunInference APIs in Apache Beam have been tested
     on torch>=1.9.0,<1.14.0.
     """
     self._state_dict_path = state_dict_path
     if device == 'GPU':
+      # Handlers are usually constructed where the pipeline is launched rather
+      # than on the workers, so GPU availability is only checked once the
+      # model is loaded.
       logging.info("Device is set to CUDA")
-      self._device = torch.device('cuda')
+      self._device = _CUDA
     else:
       logging.info("Device is set to CPU")
-      self._device = torch.device('cpu')
+      self._device = _CPU
     self._model_class = model_class
     self._model_params = model_params
     self._inference_fn = inference_fn
@@ -383,15 +1093,34 @@ class PytorchModelHandlerKeyedTensor(ModelHandler[Dict[str, torch.Tensor],
       self._batching_kwargs['min_batch_size'] = min_batch_size
     if max_batch_size is not None:
       self._batching_kwargs['max_batch_size'] = max_batch_size
+    _validate_torch_compile_kwargs(torch_compile_kwargs)
+    self._torch_compile_kwargs = torch_compile_kwargs
+    if num_threads is not None and num_threads < 1:
+      raise ValueError(f'num_threads must be positive, got {num_threads}.')
+    self._num_threads = num_threads
+    # (inference_args, device, inference_args with Tensors moved to device)
+    self._device_inference_args = (None, None, None)
+    if inference_dtype not in _INFERENCE_DTYPES:
+      raise ValueError(
+          f'inference_dtype must be one of {_INFERENCE_DTYPES}, got '
+          f'{inference_dtype}.')
+    self._inference_dtype = inference_dtype
+    self._length_fn = length_fn
 
   def load_model(self) -> torch.nn.Module:
     """Loads and initializes a Pytorch model for processing."""
+    _set_num_threads(self._num_threads)
     model, device = _load_model(
         self._model_class,
         self._state_dict_path,
         self._device,
         **self._model_params)
     self._device = device
+    if self._inference_dtype == torch.qint8:
+      model = _quantize_model(model, device)
+    if self._torch_compile_kwargs is not None:
+      model = _compile_model(
+          model, self._torch_compile_kwargs, self._batching_kwargs)
     return model
 
   def update_model_path(self, model_path: Optional[str] = None):
@@ -418,15 +1147,51 @@ class PytorchModelHandlerKeyedTensor(ModelHandler[Dict[str, torch.Tensor],
       model: A PyTorch model.
       inference_args: Non-batchable arguments required as inputs to the model's
         forward() function. Unlike Tensors in `batch`, these parameters will
-        not be dynamically batched
+        not be dynamically batched. Tensors among them are moved to the
+        model's device. Arguments that must stay on the host, e.g. the
+        lengths passed to pack_padded_sequence(), can be passed as lists.
 
     Returns:
       An Iterable of type PredictionResult.
     """
-    inference_args = {} if not inference_args else inference_args
-
-    return self._inference_fn(
-        batch, model, self._device, inference_args, self._state_dict_path)
+    inference_args = self._get_device_inference_args(inference_args)
+
+    with _autocast(self._device, self._inference_dtype):
+      if self._length_fn is None:
+        return self._inference_fn(
+            batch, model, self._device, inference_args, self._state_dict_path)
+
+      # Run examples of the same length together, then restore the order.
+      lengths = [self._length_fn(example) for example in batch]
+      order = sorted(range(len(batch)), key=lengths.__getitem__)
+      predictions = [None] * len(batch)
+      for _, group in itertools.groupby(order, key=lengths.__getitem__):
+        indices = list(group)
+        results = self._inference_fn([batch[i] for i in indices],
+                                     model,
+                                     self._device,
+                                     inference_args,
+                                     self._state_dict_path)
+        for i, result in zip(indices, results):
+          predictions[i] = result
+    return predictions
+
+  def _get_device_inference_args(
+      self, inference_args: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Returns inference_args with their Tensors moved to the model's device.
+
+    RunInference passes the same inference_args to every batch, so the moved
+    Tensors are cached rather than transferred again for each batch.
+    """
+    if not inference_args:
+      return {}
+    source, device, device_inference_args = self._device_inference_args
+    if source is not inference_args or device != self._device:
+      device_inference_args = _inference_args_to_device(
+          inference_args, self._device)
+      self._device_inference_args = (
+          inference_args, self._device, device_inference_args)
+    return device_inference_args
 
   def get_num_bytes(self, batch: Sequence[torch.Tensor]) -> int:
     """
@@ -434,8 +1199,9 @@ class PytorchModelHandlerKeyedTensor(ModelHandler[Dict[str, torch.Tensor],
        The number of bytes of data for a batch of Dict of Tensors.
     """
     # If elements in `batch` are provided as a dictionaries from key to Tensors
-    return sum(
-        (el.element_size() for tensor in batch for el in tensor.values()))
+    return sum((
+        tensor.numel() * tensor.element_size() for example in batch
+        for tensor in example.values()))
 
   def get_metrics_namespace(self) -> str:
     """
@@ -17,12 +17,17 @@
 
 # pytype: skip-file
 
+import collections
+import errno
+import gzip
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 from collections import OrderedDict
 
+import mock
 import numpy as np
 import pytest
 
@@ -35,6 +40,7 @@ from apache_beam.testing.util import equal_to
 # pylint: disable=wrong-import-order, wrong-import-position, ungrouped-imports
 try:
   import torch
+  from apache_beam.ml.inference import pytorch_inference
   from apache_beam.ml.inference.base import PredictionResult
   from apache_beam.ml.inference.base import RunInference
   from apache_beam.ml.inference.pytorch_inference import default_keyed_tensor_inference_fn
@@ -123,14 +129,25 @@ class TestPytorchModelHandlerForInferenceOnly(PytorchModelHandlerTensor):
     self._device = device
     self._inference_fn = inference_fn
     self._state_dict_path = None
+    self._inference_dtype = None
+    self._device_inference_args = (None, None, None)
+    self._use_cuda_graphs = False
 
 
 class TestPytorchModelHandlerKeyedTensorForInferenceOnly(
     PytorchModelHandlerKeyedTensor):
-  def __init__(self, device, *, inference_fn=default_keyed_tensor_inference_fn):
+  def __init__(
+      self,
+      device,
+      *,
+      inference_fn=default_keyed_tensor_inference_fn,
+      length_fn=None):
     self._device = device
     self._inference_fn = inference_fn
     self._state_dict_path = None
+    self._inference_dtype = None
+    self._device_inference_args = (None, None, None)
+    self._length_fn = length_fn
 
 
 def _compare_prediction_result(x, y):
@@ -348,6 +365,37 @@ class PytorchRunInferenceTest(unittest.TestCase):
     for actual, expected in zip(predictions, KEYED_TORCH_DICT_OUT_PREDICTIONS):
       self.assertTrue(_compare_prediction_result(actual, expected))
 
+  def test_run_inference_keyed_length_fn(self):
+    class PytorchSum(torch.nn.Module):
+      def forward(self, k1):
+        return k1.sum(dim=1, keepdim=True)
+
+    examples = [
+        {
+            'k1': torch.from_numpy(np.array([1, 2], dtype="float32"))
+        },
+        {
+            'k1': torch.from_numpy(np.array([3], dtype="float32"))
+        },
+        {
+            'k1': torch.from_numpy(np.array([4, 5, 6], dtype="float32"))
+        },
+        {
+            'k1': torch.from_numpy(np.array([7, 8], dtype="float32"))
+        },
+    ]
+    expected_predictions = [
+        PredictionResult(ex, ex['k1'].sum(dim=0, keepdim=True))
+        for ex in examples
+    ]
+
+    inference_runner = TestPytorchModelHandlerKeyedTensorForInferenceOnly(
+        torch.device('cpu'), length_fn=lambda example: len(example['k1']))
+    predictions = inference_runner.run_inference(examples, PytorchSum())
+    self.assertEqual(len(expected_predictions), len(predictions))
+    for actual, expected in zip(predictions, expected_predictions):
+      self.assertTrue(_compare_prediction_result(actual, expected))
+
   def test_inference_runner_inference_args(self):
     """
     This tests for non-batchable input arguments. Since we do the batching
@@ -374,6 +422,71 @@ class PytorchRunInferenceTest(unittest.TestCase):
     for actual, expected in zip(predictions, KEYED_TORCH_PREDICTIONS):
       self.assertEqual(actual, expected)
 
+  def test_run_inference_outputs_view_inputs(self):
+    class PytorchIdentity(torch.nn.Module):
+      def forward(self, x):
+        return x
+
+    class PytorchSlice(torch.nn.Module):
+      def forward(self, x):
+        return x[:, :1]
+
+    class PytorchNumpy(torch.nn.Module):
+      def forward(self, x):
+        return x.numpy()
+
+    first_batch = [torch.Tensor([1, 2]), torch.Tensor([3, 4])]
+    second_batch = [torch.Tensor([5, 6]), torch.Tensor([7, 8])]
+    for model in (PytorchIdentity(), PytorchSlice(), PytorchNumpy()):
+      inference_runner = TestPytorchModelHandlerForInferenceOnly(
+          torch.device('cpu'))
+      first_predictions = [
+          result.inference
+          for result in inference_runner.run_inference(first_batch, model)
+      ]
+      list(inference_runner.run_inference(second_batch, model))
+      # Predictions of the first batch must not be overwritten by the second.
+      for example, prediction in zip(first_batch, first_predictions):
+        self.assertTrue(
+            np.array_equal(
+                example[:len(prediction)].numpy(), np.asarray(prediction)))
+
+  def test_run_inference_sparse_outputs(self):
+    class PytorchSparse(torch.nn.Module):
+      def forward(self, x):
+        return x.to_sparse()
+
+    model = PytorchSparse()
+    inference_runner = TestPytorchModelHandlerForInferenceOnly(
+        torch.device('cpu'))
+    for batch in ([torch.Tensor([1, 0]),
+                   torch.Tensor([0, 2])], [torch.Tensor([3, 0]),
+                                           torch.Tensor([0, 4])]):
+      predictions = inference_runner.run_inference(batch, model)
+      for example, prediction in zip(batch, predictions):
+        self.assertTrue(torch.equal(example, prediction.inference.to_dense()))
+
+  def test_inference_args_cached(self):
+    inference_runner = TestPytorchModelHandlerForInferenceOnly(
+        torch.device('cpu'))
+    inference_args = {
+        'prediction_param_array': torch.ones(2), 'prediction_param_bool': True
+    }
+    device_inference_args = inference_runner._get_device_inference_args(
+        inference_args)
+    self.assertEqual(inference_args, device_inference_args)
+    self.assertIs(
+        device_inference_args,
+        inference_runner._get_device_inference_args(inference_args))
+
+    new_inference_args = dict(inference_args)
+    new_device_inference_args = inference_runner._get_device_inference_args(
+        new_inference_args)
+    self.assertIsNot(device_inference_args, new_device_inference_args)
+    self.assertIs(
+        new_device_inference_args,
+        inference_runner._get_device_inference_args(new_inference_args))
+
   def test_run_inference_helper(self):
     examples = [
         torch.from_numpy(np.array([1], dtype="float32")),
@@ -454,6 +567,200 @@ class PytorchRunInferenceTest(unittest.TestCase):
     self.assertEqual((examples[0].element_size()) * 8,
                      inference_runner.get_num_bytes(examples))
 
+  def test_num_bytes_keyed(self):
+    inference_runner = TestPytorchModelHandlerKeyedTensorForInferenceOnly(
+        torch.device('cpu'))
+    examples = [{
+        'k1': torch.zeros((3, 2), dtype=torch.float32),
+        'k2': torch.zeros((5, ), dtype=torch.int64)
+    }] * 2
+    self.assertEqual((3 * 2 * 4 + 5 * 8) * 2,
+                     inference_runner.get_num_bytes(examples))
+
+  def test_invalid_inference_dtype(self):
+    with self.assertRaisesRegex(ValueError, "inference_dtype must be one of"):
+      PytorchModelHandlerTensor(
+          state_dict_path='my_state_dict_path',
+          model_class=PytorchLinearRegression,
+          model_params={
+              'input_dim': 1, 'output_dim': 1
+          },
+          inference_dtype=torch.int8)
+
+  def test_cuda_graphs_custom_inference_fn(self):
+    with self.assertRaisesRegex(ValueError, "default inference_fn"):
+      PytorchModelHandlerTensor(
+          state_dict_path='my_state_dict_path',
+          model_class=PytorchLinearRegression,
+          model_params={
+              'input_dim': 1, 'output_dim': 1
+          },
+          inference_fn=custom_tensor_inference_fn,
+          use_cuda_graphs=True)
+
+  def test_cuda_graphs_autocast_inference_dtype(self):
+    for inference_dtype in (torch.float16, torch.bfloat16):
+      with self.assertRaisesRegex(ValueError, "float16 or bfloat16"):
+        PytorchModelHandlerTensor(
+            state_dict_path='my_state_dict_path',
+            model_class=PytorchLinearRegression,
+            model_params={
+                'input_dim': 1, 'output_dim': 1
+            },
+            inference_dtype=inference_dtype,
+            use_cuda_graphs=True)
+
+  def test_cuda_graphs_cpu_model(self):
+    model_handler = PytorchModelHandlerTensor(
+        state_dict_path='my_state_dict_path',
+        model_class=PytorchLinearRegression,
+        model_params={
+            'input_dim': 1, 'output_dim': 1
+        },
+        use_cuda_graphs=True)
+    model = PytorchLinearRegression(input_dim=1, output_dim=1)
+    model.load_state_dict(
+        OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                     ('linear.bias', torch.Tensor([0.5]))]))
+    predictions = model_handler.run_inference([torch.Tensor([1.0])], model)
+    self.assertTrue(
+        torch.equal(torch.Tensor([2.5]), next(iter(predictions)).inference))
+    # Models on the CPU run eagerly.
+    self.assertNotIn(model, pytorch_inference._cuda_graph_runners)
+
+  def test_clone_tensors(self):
+    Output = collections.namedtuple('Output', ['logits', 'labels'])
+
+    class ModelOutput(OrderedDict):
+      pass
+
+    tensor = torch.ones(2)
+    outputs = [
+        tensor, {
+            'logits': tensor
+        },
+        ModelOutput(logits=tensor),
+        Output(tensor, [tensor]), (tensor, 'label')
+    ]
+    cloned_outputs = pytorch_inference._clone_tensors(outputs)
+    self.assertEqual([list, torch.Tensor, dict, ModelOutput, Output, tuple],
+                     [type(cloned_outputs)] +
+                     [type(output) for output in cloned_outputs])
+    self.assertIsNot(tensor, cloned_outputs[0])
+    self.assertIsNot(tensor, cloned_outputs[1]['logits'])
+    self.assertIsNot(tensor, cloned_outputs[2]['logits'])
+    self.assertIsNot(tensor, cloned_outputs[3].logits)
+    self.assertIsNot(tensor, cloned_outputs[3].labels[0])
+    self.assertIsNot(tensor, cloned_outputs[4][0])
+    self.assertEqual('label', cloned_outputs[4][1])
+    self.assertTrue(torch.equal(tensor, cloned_outputs[3].logits))
+
+  def test_cuda_graph_runner_shared_by_threads(self):
+    model = PytorchLinearRegression(input_dim=1, output_dim=1)
+    runners = []
+    threads = [
+        threading.Thread(
+            target=lambda: runners.append(
+                pytorch_inference._get_cuda_graph_runner(model)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(4, len(runners))
+    for runner in runners:
+      self.assertIs(runners[0], runner)
+    self.assertIsNot(
+        runners[0],
+        pytorch_inference._get_cuda_graph_runner(
+            PytorchLinearRegression(input_dim=1, output_dim=1)))
+
+  def _set_num_threads(self, num_threads, environ):
+    with mock.patch.dict(os.environ, environ, clear=True):
+      with mock.patch.object(torch, 'set_num_threads') as set_num_threads:
+        with mock.patch.object(torch, 'set_num_interop_threads'):
+          with mock.patch.object(os, 'cpu_count', return_value=8):
+            pytorch_inference._set_num_threads(num_threads)
+    return set_num_threads
+
+  def test_set_num_threads(self):
+    self._set_num_threads(3, {}).assert_called_once_with(3)
+    self._set_num_threads(None, {}).assert_not_called()
+    self._set_num_threads(None, {
+        'BEAM_CPU_THREADS_PER_WORKER': '2'
+    }).assert_called_once_with(2)
+    self._set_num_threads(None, {
+        'BEAM_WORKERS_PER_VM': '2'
+    }).assert_called_once_with(4)
+    self._set_num_threads(None, {
+        'BEAM_WORKERS_PER_VM': '16'
+    }).assert_called_once_with(1)
+
+  def test_set_num_threads_invalid_environ(self):
+    for name, value in [('BEAM_CPU_THREADS_PER_WORKER', '0'),
+                        ('BEAM_CPU_THREADS_PER_WORKER', 'many'),
+                        ('BEAM_WORKERS_PER_VM', '0'),
+                        ('BEAM_WORKERS_PER_VM', '-1')]:
+      with self.assertLogs(level='WARNING') as log:
+        self._set_num_threads(None, {name: value}).assert_not_called()
+      self.assertIn('must be a positive integer', log.output[0])
+    # An invalid BEAM_CPU_THREADS_PER_WORKER falls back to BEAM_WORKERS_PER_VM.
+    self._set_num_threads(
+        None, {
+            'BEAM_CPU_THREADS_PER_WORKER': '0', 'BEAM_WORKERS_PER_VM': '2'
+        }).assert_called_once_with(4)
+
+  def test_torch_compile_kwargs_cuda_graphs(self):
+    for name, value in [('mode', 'reduce-overhead'),
+                        ('mode', 'max-autotune'),
+                        ('options', {'triton.cudagraphs': True})]:
+      for handler_class in (PytorchModelHandlerTensor,
+                            PytorchModelHandlerKeyedTensor):
+        with self.assertRaisesRegex(ValueError, "must not enable CUDA graphs"):
+          handler_class(
+              state_dict_path='my_state_dict_path',
+              model_class=PytorchLinearRegression,
+              model_params={
+                  'input_dim': 1, 'output_dim': 1
+              },
+              torch_compile_kwargs={name: value})
+    PytorchModelHandlerTensor(
+        state_dict_path='my_state_dict_path',
+        model_class=PytorchLinearRegression,
+        model_params={
+            'input_dim': 1, 'output_dim': 1
+        },
+        torch_compile_kwargs={'mode': 'max-autotune-no-cudagraphs'})
+
+  def test_compile_model(self):
+    model = PytorchLinearRegression(input_dim=1, output_dim=1)
+    with mock.patch.object(torch, 'compile', create=True) as compile_mock:
+      compiled_model = pytorch_inference._compile_model(
+          model, {'mode': 'max-autotune'}, {'max_batch_size': 4})
+    compile_mock.assert_called_once_with(model, mode='max-autotune')
+    self.assertIs(compile_mock.return_value, compiled_model)
+
+  def test_compile_model_static_batch_size(self):
+    model = PytorchLinearRegression(input_dim=1, output_dim=1)
+    batching_kwargs = {'min_batch_size': 4, 'max_batch_size': 4}
+    with mock.patch.object(torch, 'compile', create=True) as compile_mock:
+      pytorch_inference._compile_model(model, {}, batching_kwargs)
+      pytorch_inference._compile_model(
+          model, {'dynamic': True}, batching_kwargs)
+    self.assertEqual(
+        [mock.call(model, dynamic=False), mock.call(model, dynamic=True)],
+        compile_mock.call_args_list)
+
+  def test_compile_model_unsupported(self):
+    model = PytorchLinearRegression(input_dim=1, output_dim=1)
+    # Emulates torch<2.0, which does not provide torch.compile().
+    with mock.patch.dict(torch.__dict__):
+      torch.__dict__.pop('compile', None)
+      with self.assertLogs(level='WARNING') as log:
+        self.assertIs(model, pytorch_inference._compile_model(model, {}, {}))
+    self.assertIn('torch.compile() requires torch>=2.0', log.output[0])
+
   def test_namespace(self):
     inference_runner = TestPytorchModelHandlerForInferenceOnly(
         torch.device('cpu'))
@@ -640,6 +947,171 @@ class PytorchRunInferencePipelineTest(unittest.TestCase):
           predictions,
           equal_to(expected_predictions, equals_fn=_compare_prediction_result))
 
+  def _assert_loads_state_dict(self, path):
+    state_dict = pytorch_inference._load_state_dict(path, torch.device('cpu'))
+    self.assertEqual(['linear.weight', 'linear.bias'], list(state_dict))
+    self.assertTrue(
+        torch.equal(torch.Tensor([[2.0]]), state_dict['linear.weight']))
+    self.assertTrue(torch.equal(torch.Tensor([0.5]), state_dict['linear.bias']))
+
+  def test_load_state_dict_local(self):
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    torch.save(state_dict, path)
+    self._assert_loads_state_dict(path)
+
+  def test_load_state_dict_compressed(self):
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path.gz')
+    with gzip.open(path, 'wb') as file:
+      torch.save(state_dict, file)
+    self._assert_loads_state_dict(path)
+
+  def test_load_state_dict_out_of_disk(self):
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path.gz')
+    with gzip.open(path, 'wb') as file:
+      torch.save(state_dict, file)
+    with mock.patch.object(pytorch_inference,
+                           '_download',
+                           side_effect=OSError(errno.ENOSPC, 'No space left')):
+      with self.assertLogs(level='WARNING') as log:
+        self._assert_loads_state_dict(path)
+    self.assertIn('reading it into memory instead', log.output[0])
+
+  def test_load_state_dict_legacy_format(self):
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    torch.save(state_dict, path, _use_new_zipfile_serialization=False)
+    self._assert_loads_state_dict(path)
+
+  def _save_linear_regression(self):
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0, 3]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    torch.save(state_dict, path)
+    return path
+
+  def test_inference_dtype_qint8(self):
+    model_handler = PytorchModelHandlerTensor(
+        state_dict_path=self._save_linear_regression(),
+        model_class=PytorchLinearRegression,
+        model_params={
+            'input_dim': 2, 'output_dim': 1
+        },
+        inference_dtype=torch.qint8)
+    model = model_handler.load_model()
+    self.assertNotIsInstance(model.linear, torch.nn.Linear)
+    self.assertEqual(torch.qint8, model.linear.weight().dtype)
+    predictions = model_handler.run_inference(TWO_FEATURES_EXAMPLES, model)
+    for actual, expected in zip(predictions, TWO_FEATURES_PREDICTIONS):
+      self.assertTrue(
+          torch.allclose(expected.inference, actual.inference, atol=0.5))
+
+  def test_inference_dtype_bfloat16(self):
+    model_handler = PytorchModelHandlerTensor(
+        state_dict_path=self._save_linear_regression(),
+        model_class=PytorchLinearRegression,
+        model_params={
+            'input_dim': 2, 'output_dim': 1
+        },
+        inference_dtype=torch.bfloat16)
+    model = model_handler.load_model()
+    predictions = model_handler.run_inference(TWO_FEATURES_EXAMPLES, model)
+    for actual, expected in zip(predictions, TWO_FEATURES_PREDICTIONS):
+      self.assertEqual(torch.bfloat16, actual.inference.dtype)
+      self.assertTrue(
+          torch.allclose(
+              expected.inference, actual.inference.float(), rtol=0.02))
+
+  def test_quantize_model_gpu(self):
+    model = PytorchLinearRegression(input_dim=2, output_dim=1)
+    with self.assertLogs(level='WARNING') as log:
+      self.assertIs(
+          model, pytorch_inference._quantize_model(model, torch.device('cuda')))
+    self.assertIn('only supported on CPU devices', log.output[0])
+
+  def test_load_model_with_tensor_attribute(self):
+    class PytorchScaledLinearRegression(PytorchLinearRegression):
+      def __init__(self, input_dim, output_dim):
+        super().__init__(input_dim, output_dim)
+        self.scale = torch.tensor(2.0)
+
+      def forward(self, x):
+        return self.linear(x) * self.scale
+
+    state_dict = OrderedDict([('linear.weight', torch.Tensor([[2.0]])),
+                              ('linear.bias', torch.Tensor([0.5]))])
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    torch.save(state_dict, path)
+
+    model_handler = PytorchModelHandlerTensor(
+        state_dict_path=path,
+        model_class=PytorchScaledLinearRegression,
+        model_params={
+            'input_dim': 1, 'output_dim': 1
+        })
+    model = model_handler.load_model()
+    self.assertEqual(torch.device('cpu'), model.scale.device)
+    predictions = model_handler.run_inference([torch.Tensor([1.0])], model)
+    self.assertTrue(
+        torch.equal(torch.Tensor([5.0]), next(iter(predictions)).inference))
+
+  def test_download_ranges(self):
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    local_path = os.path.join(self.tmpdir, 'my_local_state_dict_path')
+    data = os.urandom(100)
+    with open(path, 'wb') as file:
+      file.write(data)
+
+    download_range = mock.Mock(wraps=pytorch_inference._download_range)
+    with mock.patch.object(pytorch_inference, '_READ_BUFFER_SIZE', 16):
+      with mock.patch.object(pytorch_inference,
+                             '_download_range',
+                             download_range):
+        pytorch_inference._download(path, local_path)
+    self.assertEqual(7, download_range.call_count)
+    with open(local_path, 'rb') as file:
+      self.assertEqual(data, file.read())
+
+  def test_download_sequential_fallback(self):
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    local_path = os.path.join(self.tmpdir, 'my_local_state_dict_path')
+    data = os.urandom(100)
+    with open(path, 'wb') as file:
+      file.write(data)
+
+    with mock.patch.object(pytorch_inference, '_READ_BUFFER_SIZE', 16):
+      with mock.patch.object(pytorch_inference,
+                             '_download_range',
+                             side_effect=NotImplementedError):
+        with self.assertLogs(level='WARNING') as log:
+          pytorch_inference._download(path, local_path)
+    self.assertIn('reading it sequentially instead', log.output[0])
+    with open(local_path, 'rb') as file:
+      self.assertEqual(data, file.read())
+
+  def test_download_out_of_disk(self):
+    path = os.path.join(self.tmpdir, 'my_state_dict_path')
+    local_path = os.path.join(self.tmpdir, 'my_local_state_dict_path')
+    with open(path, 'wb') as file:
+      file.write(os.urandom(100))
+
+    with mock.patch.object(pytorch_inference, '_READ_BUFFER_SIZE', 16):
+      with mock.patch.object(pytorch_inference,
+                             '_download_range',
+                             side_effect=OSError(errno.ENOSPC,
+                                                 'No space left')):
+        with mock.patch.object(shutil, 'copyfileobj') as copyfileobj:
+          with self.assertRaises(OSError):
+            pytorch_inference._download(path, local_path)
+    # A sequential read would run out of disk just the same.
+    copyfileobj.assert_not_called()
+
   def test_invalid_input_type(self):
     with self.assertRaisesRegex(TypeError, "expected Tensor as element"):
       with TestPipeline() as pipeline: